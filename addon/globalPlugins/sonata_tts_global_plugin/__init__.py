@@ -21,16 +21,24 @@ addonHandler.initTranslation()
 _DIR = os.path.abspath(os.path.dirname(__file__))
 _ADDON_ROOT = os.path.abspath(os.path.join(_DIR, os.pardir, os.pardir))
 _TTS_MODULE_DIR = os.path.join(_ADDON_ROOT, "synthDrivers")
+# This is the only place that imports the synth modules by path.
+# Sibling modules import them from this package, so the plugin uses a single copy of them.
+# NVDA loads the synth driver itself as `synthDrivers.sonata_neural_voices`, which is
+# a separate copy with its own installed voices cache: invalidating the cache here
+# doesn't reach the driver, which refreshes its own cache (see `SynthDriver.refresh_voices`)
 sys.path.insert(0, _TTS_MODULE_DIR)
-from sonata_neural_voices import helpers
-from sonata_neural_voices import aio
-from sonata_neural_voices.tts_system import (
-    SonataTextToSpeechSystem,
-    SONATA_VOICES_DIR,
-)
-sys.path.remove(_TTS_MODULE_DIR)
+try:
+    from sonata_neural_voices import helpers
+    from sonata_neural_voices import aio
+    from sonata_neural_voices.tts_system import (
+        SonataTextToSpeechSystem,
+        SONATA_VOICES_DIR,
+    )
+finally:
+    sys.path.remove(_TTS_MODULE_DIR)
 del _DIR, _ADDON_ROOT, _TTS_MODULE_DIR
 
+from . import voice_download
 from .voice_manager import SonataVoiceManagerDialog
 
 
@@ -58,20 +66,35 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
     def _perform_voice_check(self):
         if self.__voice_manager_shown:
             return
-        if not any(SonataTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()):
-            retval = gui.messageBox(
-                # Translators: message telling the user that no voice is installed
-                _(
-                    "No Sonata voice was found.\n"
-                    "You can preview and download voices from the voice manager.\n"
-                    "Do you want to open the voice manager now?"
-                ),
-                # Translators: title of a message telling the user that no Sonata voice was found
-                _("Sonata Neural Voices"),
-                wx.YES_NO | wx.ICON_WARNING,
-            )
-            if retval == wx.YES:
-                self.on_manager(None)
+        voice_download.get_thread_pool_executor().submit(
+            SonataTextToSpeechSystem.has_any_installed_voice
+        ).add_done_callback(self._on_voice_check_done)
+
+    def _on_voice_check_done(self, future):
+        try:
+            has_voices = future.result()
+        except:
+            log.exception("Failed to check for installed voices", exc_info=True)
+            return
+        if not has_voices:
+            wx.CallAfter(self._show_no_voice_prompt)
+
+    def _show_no_voice_prompt(self):
+        if self.__voice_manager_shown:
+            return
+        retval = gui.messageBox(
+            # Translators: message telling the user that no voice is installed
+            _(
+                "No Sonata voice was found.\n"
+                "You can preview and download voices from the voice manager.\n"
+                "Do you want to open the voice manager now?"
+            ),
+            # Translators: title of a message telling the user that no Sonata voice was found
+            _("Sonata Neural Voices"),
+            wx.YES_NO | wx.ICON_WARNING,
+        )
+        if retval == wx.YES:
+            self.on_manager(None)
 
     def terminate(self):
         try:
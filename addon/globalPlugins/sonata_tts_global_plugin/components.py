@@ -7,6 +7,7 @@ from __future__ import annotations
 
 import dataclasses
 import contextlib
+import operator
 import typing
 
 import wx
@@ -23,7 +24,6 @@ ObjectCollection = typing.Iterable[typing.Any]
 def make_sized_static_box(parent, title):
     stbx = sc.SizedStaticBox(parent, -1, title)
     stbx.SetSizerProp("expand", True)
-    stbx.Sizer.AddSpacer(25)
     return stbx
 
 
@@ -149,18 +149,30 @@ class AsyncSnakDialog:
         func,
         done_callback: DoneCallback,
         *sdg_args,
+        cancellable=False,
         **sdg_kwargs,
     ):
+        self.user_dismiss_callback = sdg_kwargs.pop("dismiss_callback", None)
+        # Dismissing the dialog only cancels the task if the caller asks for it,
+        # otherwise the dialog can't be dismissed until the task is done
+        if cancellable or (self.user_dismiss_callback is not None):
+            sdg_kwargs["dismiss_callback"] = self.on_dismiss
         self.snak_dg = SnakDialog(*sdg_args, **sdg_kwargs)
         self.done_callback = done_callback
-        self.future = executor.submit(func).add_done_callback(
-            self.on_future_completed
-        )
+        self.future = executor.submit(func)
+        self.future.add_done_callback(self.on_future_completed)
         self.snak_dg.CenterOnScreen()
         gui.runScriptModalDialog(self.snak_dg)
 
+    def on_dismiss(self):
+        # Only stops the task if it has not started yet
+        self.future.cancel()
+        if self.user_dismiss_callback is not None:
+            return self.user_dismiss_callback()
+
     def on_future_completed(self, completed_future):
         self.Dismiss()
+        # Cancelled tasks are reported too, callers can check `future.cancelled()`
         wx.CallAfter(self.done_callback, completed_future)
 
     def Dismiss(self):
@@ -170,12 +182,14 @@ class AsyncSnakDialog:
             wx.CallAfter(self.snak_dg.Destroy)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True, frozen=True)
 class ColumnDefn:
     title: str
     alignment: str
     width: int
     string_converter: t.Union[typing.Callable[[typing.Any], str], str]
+    extractor: typing.Callable[[typing.Any], str] = dataclasses.field(init=False, repr=False, compare=False)
+    alignment_flag: int = dataclasses.field(init=False, repr=False, compare=False)
 
     _ALIGNMENT_FLAGS = {
         "left": wx.LIST_FORMAT_LEFT,
@@ -183,12 +197,18 @@ class ColumnDefn:
         "right": wx.LIST_FORMAT_RIGHT,
     }
 
-    @property
-    def alignment_flag(self):
+    def __post_init__(self):
         flag = self._ALIGNMENT_FLAGS.get(self.alignment)
-        if flag is not None:
-            return flag
-        raise ValueError(f"Unknown alignment directive {self.alignment}")
+        if flag is None:
+            raise ValueError(f"Unknown alignment directive {self.alignment}")
+        # Columns are frozen, so derived fields are set through object.__setattr__
+        object.__setattr__(self, "alignment_flag", flag)
+        # Resolve the converter once instead of checking its type for every row
+        if callable(self.string_converter):
+            extractor = self.string_converter
+        else:
+            extractor = operator.attrgetter(self.string_converter)
+        object.__setattr__(self, "extractor", extractor)
 
 
 class ImmutableObjectListView(DialogListCtrl):
@@ -222,27 +242,32 @@ class ImmutableObjectListView(DialogListCtrl):
         self._columns = columns
         for col in self._columns:
             self.AppendColumn(col.title, format=col.alignment_flag, width=col.width)
-        for i in range(len(columns)):
-            self.SetColumnWidth(i, 100)
 
     def set_objects(
         self, objects: ObjectCollection, focus_item: int = 0, set_focus=True
     ):
         """Clear the list view and insert the objects."""
         self._objects = objects
-        self.set_columns(self._columns)
-        string_converters = [c.string_converter for c in self._columns]
-        with self.__unsafe_modify():
-            for obj in self._objects:
-                col_labels = []
-                for to_str in string_converters:
-                    col_labels.append(
-                        getattr(obj, to_str) if not callable(to_str) else to_str(obj)
-                    )
-                self.Append(col_labels)
+        extractors = list(enumerate(c.extractor for c in self._columns))
+        self.Freeze()
+        try:
+            with self.__unsafe_modify():
+                # Columns are set up once, only the rows change
+                self.DeleteAllItems()
+                if extractors:
+                    self._insert_rows(extractors)
+        finally:
+            self.Thaw()
         if set_focus:
             self.set_focused_item(focus_item)
 
+    def _insert_rows(self, extractors):
+        (__, extract_label), *other_extractors = extractors
+        for index, obj in enumerate(self._objects):
+            self.InsertItem(index, str(extract_label(obj)))
+            for col, extract in other_extractors:
+                self.SetItem(index, col, str(extract(obj)))
+
     def get_selected(self) -> typing.Optional[typing.Any]:
         """Return the currently selected object or None."""
         idx = self.GetFocusedItem()
@@ -4,20 +4,18 @@
 # This file is covered by the GNU General Public License.
 
 
+import contextlib
+import functools
 import json
-import math
+import operator
 import os
 import re
-import shutil
-import tarfile
-import tempfile
+import threading
+import time
 import typing
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum, auto
-from fnmatch import fnmatch
 from functools import partial
-from hashlib import md5
-from http.client import HTTPException
 from io import BytesIO
 
 import wx
@@ -30,7 +28,6 @@ from . import SonataTextToSpeechSystem, helpers, SONATA_VOICES_DIR
 
 with helpers.import_bundled_library():
     import mureq as request
-    from concurrent.futures import ThreadPoolExecutor
     from pathlib import Path
 
 
@@ -38,16 +35,47 @@ PIPER_VOICE_LIST_URL = f"https://huggingface.co/rhasspy/piper-voices/resolve/v1.
 PIPER_VOICE_DOWNLOAD_URL_PREFIX = "https://huggingface.co/rhasspy/piper-voices/resolve/v1.0.0"
 PIPER_SAMPLES_URL_PREFIX = "https://rhasspy.github.io/piper-samples/samples"
 PIPER_VOICES_JSON_LOCAL_CACHE = os.path.join(SONATA_VOICES_DIR, "piper-voices.json")
+RT_VOICES_JSON_LOCAL_CACHE = os.path.join(SONATA_VOICES_DIR, "piper-rt-voices.json")
 RT_VOICE_LIST_URL = "https://huggingface.co/datasets/mush42/piper-rt/resolve/main/voices.json"
 RT_VOICE_DOWNLOAD_URL_PREFIX = "https://huggingface.co/datasets/mush42/piper-rt/resolve/main/"
 
 VOICE_INFO_REGEX = re.compile(
-    r"(?P<language>[a-z]+(_|-)?([a-z]+)?)(-|_)"
-    r"(?P<name>[a-z|_]+(\+RT)?)(-|_)"
-    r"(?P<quality>(high|medium|low|x-low|x_low))",
+    r"\A(?P<language>[a-z]{2,3}(?:[-_][a-z]{2,3})?)[-_]"
+    r"(?P<name>[a-z0-9]+(?:_[a-z0-9]+)*(?:\+RT)?)[-_]"
+    r"(?P<quality>x[-_]low|low|medium|high)\Z",
     re.I
 )
-THREAD_POOL_EXECUTOR = ThreadPoolExecutor()
+VOICE_QUALITIES = frozenset({"x_low", "low", "medium", "high"})
+TAR_COPY_BUFFER_SIZE = 4 * 1024 * 1024
+TAR_READ_BUFFER_SIZE = 64 * 1024
+# Anything smaller than this cannot possibly contain a voice model
+MIN_VOICE_ARCHIVE_SIZE = 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+VOICE_LIST_CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+# How often (in milliseconds) the progress dialog picks up the download progress
+PROGRESS_POLL_INTERVAL = 100
+# Downloads are network bound, so a few workers are enough.
+# Workers hold no per-thread HTTP state: mureq opens a connection per request
+THREAD_POOL_MAX_WORKERS = 4
+_THREAD_POOL_EXECUTOR = None
+_THREAD_POOL_EXECUTOR_LOCK = threading.Lock()
+# How long (in seconds) the parsed voice list is reused before reading it again
+VOICE_LIST_CACHE_TTL = 300
+_voice_list_cache = {"time": None, "val": None}
+
+
+def get_thread_pool_executor():
+    """Return the executor used for downloads and other voice manager tasks, creating it on first use."""
+    global _THREAD_POOL_EXECUTOR
+    with _THREAD_POOL_EXECUTOR_LOCK:
+        if _THREAD_POOL_EXECUTOR is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _THREAD_POOL_EXECUTOR = ThreadPoolExecutor(
+                max_workers=THREAD_POOL_MAX_WORKERS,
+                thread_name_prefix="sonata_voice_manager"
+            )
+    return _THREAD_POOL_EXECUTOR
 
 
 class PiperVoiceQualityLevel(Enum):
@@ -60,35 +88,47 @@ class PiperVoiceQualityLevel(Enum):
         return " ".join(v.title() for v in self.value.split("_"))
 
 
+_QUALITY_LEVELS = {level.value: level for level in PiperVoiceQualityLevel}
+
+
 class PiperVoiceFileType(Enum):
     Onnx = auto()
     Config = auto()
     ModelCard = auto()
 
 
-@dataclass
+_FILE_SUFFIX_TO_TYPE = {
+    "onnx": PiperVoiceFileType.Onnx,
+    "json": PiperVoiceFileType.Config,
+    "": PiperVoiceFileType.ModelCard,
+}
+
+
+@dataclass(slots=True)
 class PiperVoiceFile:
     file_path: str
     size_in_bytes: int
     md5hash: str
+    name: str = field(init=False)
+    type: typing.Optional[PiperVoiceFileType] = field(init=False, repr=False, compare=False)
+    _download_url: typing.Optional[str] = field(init=False, default=None, repr=False, compare=False)
 
     def __post_init__(self):
-        self.name = os.path.split(self.file_path)[-1]
-        self.download_url = f"{PIPER_VOICE_DOWNLOAD_URL_PREFIX}/{self.file_path}"
+        # Paths in the voice list always use forward slashes
+        self.name = self.file_path.rpartition("/")[2]
+        suffix = self.name.rsplit(".", 1)[-1] if "." in self.name else ""
+        # Unknown file types are kept as `None` rather than failing the whole voice list
+        self.type = _FILE_SUFFIX_TO_TYPE.get(suffix)
 
     @property
-    def type(self):
-        suffix = Path(self.file_path).suffix.lstrip(".")
-        if suffix == "onnx":
-            return PiperVoiceFileType.Onnx
-        elif suffix == "json":
-            return PiperVoiceFileType.Config
-        elif suffix == "":
-            return PiperVoiceFileType.ModelCard
-        raise ValueError(f"Unknown file type: {suffix}")
-
-
-@dataclass(eq=False)
+    def download_url(self):
+        # Built on first access, since only the files of the voice being downloaded need it
+        if self._download_url is None:
+            self._download_url = f"{PIPER_VOICE_DOWNLOAD_URL_PREFIX}/{self.file_path}"
+        return self._download_url
+
+
+@dataclass(eq=False, slots=True)
 class PiperVoiceLanguage:
     code: str
     family: str
@@ -96,6 +136,7 @@ class PiperVoiceLanguage:
     name_native: str
     name_english: str
     country_english: str
+    _description: typing.Optional[str] = field(init=False, default=None, repr=False)
 
     def __str__(self):
         return self.code.replace("_", "-")
@@ -110,13 +151,16 @@ class PiperVoiceLanguage:
 
     @property
     def description(self):
-        code = self.code.replace("_", "-")
-        if "English" not in self.name_native:
-            return f"{self.name_english} ({self.country_english}) , {code}, {self.name_native}"
-        return f"{self.name_english} ({self.country_english}), {code}"
+        if self._description is None:
+            code = self.code.replace("_", "-")
+            if "English" not in self.name_native:
+                self._description = f"{self.name_english} ({self.country_english}) , {code}, {self.name_native}"
+            else:
+                self._description = f"{self.name_english} ({self.country_english}), {code}"
+        return self._description
 
 
-@dataclass
+@dataclass(slots=True)
 class PiperVoice:
     key: str
     name: str
@@ -128,21 +172,31 @@ class PiperVoice:
     has_rt_variant: bool = False
     standard_variant_installed: bool = False
     fast_variant_installed: bool = False
+    display_quality: str = field(init=False, repr=False, compare=False)
+    _preview_url_prefix: typing.Optional[str] = field(init=False, default=None, repr=False, compare=False)
+    _speakers: typing.Optional[typing.List[str]] = field(init=False, default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.display_quality = str(self.quality)
 
     @classmethod
-    def from_list_of_dicts(cls, voice_data):
-        retval = []
+    def from_list_of_dicts(cls, voice_data, skip_keys=frozenset()):
+        # Voices of the same language share one language object
+        languages = {}
+        retval = [
+            cls._from_dict(data, languages)
+            for data in voice_data
+            if data["key"] not in skip_keys
+        ]
+        retval.sort(key=operator.attrgetter("language.family"))
+        return retval
 
-        for data in voice_data:
-            file_list = []
-            for (path, finfo) in data["files"].items():
-                file_list.append(PiperVoiceFile(
-                    file_path=path,
-                    size_in_bytes=finfo["size_bytes"],
-                    md5hash=finfo["md5_digest"]
-                ))
-            lang_info = data["language"]
-            language = PiperVoiceLanguage(
+    @classmethod
+    def _from_dict(cls, data, languages):
+        lang_info = data["language"]
+        language = languages.get(lang_info["code"])
+        if language is None:
+            language = languages[lang_info["code"]] = PiperVoiceLanguage(
                 code=lang_info["code"],
                 family=lang_info["family"],
                 region=lang_info["region"],
@@ -150,26 +204,38 @@ class PiperVoice:
                 name_english=lang_info["name_english"],
                 country_english=lang_info["country_english"],
             )
-            retval.append(cls(
-                key=data["key"],
-                name=data["name"],
-                quality=PiperVoiceQualityLevel(data["quality"]),
-                num_speakers=data["num_speakers"],
-                speaker_id_map=data["speaker_id_map"],
-                language=language,
-                files=file_list,
-                has_rt_variant=data["has_rt_variant"],
-                standard_variant_installed=data["standard_variant_installed"],
-                fast_variant_installed=data["fast_variant_installed"]
-            ))
-
-        retval.sort(key=lambda v: v.language.family)
-        return retval
+        return cls(
+            key=data["key"],
+            name=data["name"],
+            quality=_QUALITY_LEVELS[data["quality"]],
+            num_speakers=data["num_speakers"],
+            speaker_id_map=data["speaker_id_map"],
+            language=language,
+            files=[
+                PiperVoiceFile(
+                    file_path=path,
+                    size_in_bytes=finfo["size_bytes"],
+                    md5hash=finfo["md5_digest"]
+                )
+                for (path, finfo) in data["files"].items()
+            ],
+            has_rt_variant=data["has_rt_variant"],
+            standard_variant_installed=data["standard_variant_installed"],
+            fast_variant_installed=data["fast_variant_installed"]
+        )
+
+    @property
+    def speakers(self):
+        if self._speakers is None:
+            self._speakers = list(self.speaker_id_map)
+        return self._speakers
 
     def get_preview_url(self, speaker_idx=0):
-        lang_path = f"{self.language.family.lower()}/{self.language.code}"
-        quality = self.quality.value.lower()
-        return f"{PIPER_SAMPLES_URL_PREFIX}/{lang_path}/{self.name}/{quality}/speaker_{speaker_idx}.mp3"
+        if self._preview_url_prefix is None:
+            lang_path = f"{self.language.family.lower()}/{self.language.code}"
+            quality = self.quality.value.lower()
+            self._preview_url_prefix = f"{PIPER_SAMPLES_URL_PREFIX}/{lang_path}/{self.name}/{quality}"
+        return f"{self._preview_url_prefix}/speaker_{speaker_idx}.mp3"
 
     def get_rt_variant_download_url(self):
         if not self.has_rt_variant:
@@ -178,67 +244,109 @@ class PiperVoice:
         return RT_VOICE_DOWNLOAD_URL_PREFIX + rt_voice_key + ".tar.gz"
 
 
-class PiperVoiceDownloader:
-    def __init__(self, voice: PiperVoice, success_callback):
-        self.voice = voice
-        self.success_callback = success_callback
-        self.temp_download_dir = tempfile.TemporaryDirectory()
-        self.progress_dialog = None
+def _done_callback_wrapper(done_callback, future):
+    if done_callback is None:
+        return
+    try:
+        result = future.result()
+    except Exception as e:
+        done_callback(e)
+    else:
+        done_callback(result)
+
+
+class _DownloadProgressMixin:
+    """Shows the progress of a download running on the thread pool in a progress dialog."""
+
+    progress_dialog = None
+    progress_timer = None
+    _progress = 0
+    _shown_progress = 0
 
     def update_progress(self, progress):
-        self.progress_dialog.Update(
-            progress,
+        # Called from the download threads: only record the progress,
+        # the dialog picks it up on the UI thread
+        self._progress = progress
+
+    def _poll_progress(self):
+        progress = self._progress
+        if progress != self._shown_progress:
+            self._shown_progress = progress
+            self.progress_dialog.Update(
+                progress,
+                # Translators: message of a progress dialog
+                _("Downloaded: {progress}%").format(progress=progress),
+            )
+
+    def _show_progress_dialog(self, title):
+        self.progress_dialog = wx.ProgressDialog(
+            title=title,
             # Translators: message of a progress dialog
-            _("Downloaded: {progress}%").format(progress=progress),
+            message=_("Retrieving download information..."),
+            parent=gui.mainFrame,
         )
+        self.progress_dialog.CenterOnScreen()
+        self.progress_timer = wx.PyTimer(self._poll_progress)
+        self.progress_timer.Start(PROGRESS_POLL_INTERVAL)
 
-    def done_callback(self, result):
-        has_error = isinstance(result, Exception)
-        if not has_error:
-            self.progress_dialog.Update(
+    def _end_progress(self, installing):
+        # Called from the done callback, so the dialog is only touched on the UI thread
+        wx.CallAfter(self.progress_timer.Stop)
+        if installing:
+            wx.CallAfter(
+                self.progress_dialog.Update,
                 0,
                 # Translators: message shown in the voice download progress dialog
                 _("Installing voice")
             )
-            hashes = {
-                file.md5hash: md5hash
-                for (file, __, md5hash) in result
-            }
-            if not all(k == v for (k, v) in hashes.items()):
-                has_error = True
-                log.error("File hashes do not match")
-            else:
-                voice_dir = Path(SONATA_VOICES_DIR).joinpath(self.voice.key)
-                voice_dir.mkdir(parents=True, exist_ok=True)
-                for file, src,  __ in result:
-                    dst = os.path.join(voice_dir, file.name)
-                    try:
-                        shutil.copy(src, dst)
-                    except IOError:
-                        log.exception("Failed to copy file: {file}", exc_info=True)
-                        has_error = True
 
+    def _close_progress_dialog(self):
+        wx.CallAfter(self._destroy_progress_dialog)
+
+    def _destroy_progress_dialog(self):
         self.progress_dialog.Hide()
         self.progress_dialog.Destroy()
         del self.progress_dialog
 
+
+class PiperVoiceDownloader(_DownloadProgressMixin):
+    def __init__(self, voice: PiperVoice, success_callback):
+        self.voice = voice
+        self.success_callback = success_callback
+        # Files are downloaded as `.part` files into a hidden folder next to the voice folder,
+        # which is only moved into place once all hashes are verified.
+        # Hidden directories are skipped when enumerating installed voices
+        self.voice_dir = Path(SONATA_VOICES_DIR) / self.voice.key
+        self.download_dir = Path(SONATA_VOICES_DIR) / f".downloading_{self.voice.key}"
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+
+    def done_callback(self, result):
+        has_error = isinstance(result, Exception)
+        self._end_progress(installing=not has_error)
         if not has_error:
-            self.success_callback()
-            retval = gui.messageBox(
-            # Translators: content of a message box
-            _(
-                "Successfully downloaded voice  {voice}.\n"
-                "To use this voice, you need to restart NVDA.\n"
-                "Do you want to restart NVDA now?"
-            ).format(
-                voice=self.voice.key
-            ),
-            # Translators: title of a message box
-            _("Voice downloaded"),
-                wx.YES_NO | wx.ICON_WARNING,
-            )
-            if retval == wx.YES:
-                core.restart()
+            mismatch = [
+                file.name
+                for (file, __, md5hash) in result
+                # hexdigest() is always lowercase
+                if file.md5hash.lower() != md5hash
+            ]
+            if mismatch:
+                has_error = True
+                log.error(f"File hashes do not match: {mismatch}")
+            else:
+                try:
+                    self._move_files_into_place(result)
+                except OSError:
+                    log.exception(f"Failed to install voice files: {self.voice.key}", exc_info=True)
+                    has_error = True
+        if has_error:
+            self._discard_partial_files()
+        SonataTextToSpeechSystem.invalidate_voices_cache()
+
+        self._close_progress_dialog()
+
+        if not has_error:
+            wx.CallAfter(self._on_voice_installed)
         else:
             wx.CallAfter(
                 gui.messageBox,
@@ -252,117 +360,170 @@ class PiperVoiceDownloader:
                 f"Failed to download voice.\nException: {result}"
             )
 
+    def _on_voice_installed(self):
+        self.success_callback()
+        retval = gui.messageBox(
+            # Translators: content of a message box
+            _(
+                "Successfully downloaded voice  {voice}.\n"
+                "To use this voice, you need to restart NVDA.\n"
+                "Do you want to restart NVDA now?"
+            ).format(
+                voice=self.voice.key
+            ),
+            # Translators: title of a message box
+            _("Voice downloaded"),
+            wx.YES_NO | wx.ICON_WARNING,
+        )
+        if retval == wx.YES:
+            core.restart()
+
+    def _move_files_into_place(self, result):
+        for file, src, __ in result:
+            os.replace(src, self.download_dir / file.name)
+        if not self.voice_dir.exists():
+            os.rename(self.download_dir, self.voice_dir)
+            return
+        # Complete a voice folder left over by an earlier install
+        for file, __, __ in result:
+            os.replace(self.download_dir / file.name, self.voice_dir / file.name)
+        self.download_dir.rmdir()
+
+    def _discard_partial_files(self):
+        import shutil
+
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
     def download(self):
-        self.progress_dialog = wx.ProgressDialog(
+        self._show_progress_dialog(
             # Translators: title of a progress dialog
-            title=_("Downloading voice {voice}").format(
+            _("Downloading voice {voice}").format(
                 voice=self.voice.key
-            ),
-            # Translators: message of a progress dialog
-            message=_("Retrieving download information..."),
-            parent=gui.mainFrame,
+            )
         )
-        self.progress_dialog.CenterOnScreen()
-        THREAD_POOL_EXECUTOR.submit(self.download_voice_files).add_done_callback(partial(self._done_callback_wrapper, self.done_callback))
+        get_thread_pool_executor().submit(self.download_voice_files).add_done_callback(partial(_done_callback_wrapper, self.done_callback))
 
     def download_voice_files(self):
-        retvals = []
-        for file in self.voice.files:
-            self.progress_dialog.Update(
-                0,
-                # Translators: message shown in progress dialog
-                _("Downloading file: {file}").format(file=file.name)
-            )
-            result = self._do_download_file(file, self.temp_download_dir.name, self.update_progress)
-            retvals.append(result)
+        total_size = sum(file.size_in_bytes for file in self.voice.files)
+        downloaded_bytes = {}
+        lock = threading.Lock()
 
-        return retvals
+        def report_progress(file, progress):
+            with lock:
+                downloaded_bytes[file.name] = file.size_in_bytes * progress
+                self.update_progress(sum(downloaded_bytes.values()) // total_size)
+
+        wx.CallAfter(
+            self.progress_dialog.Update,
+            0,
+            # Translators: message shown in progress dialog
+            _("Downloading file: {file}").format(
+                file=", ".join(file.name for file in self.voice.files)
+            )
+        )
+        # This runs on the thread pool itself, so download the largest file here
+        # and hand the others to the pool. Files no free worker has picked up by
+        # the time we are done are downloaded here as well, so that waiting on
+        # them can never tie up every worker of the pool
+        largest_file, *other_files = sorted(
+            self.voice.files, key=operator.attrgetter("size_in_bytes"), reverse=True
+        )
+        futures = [
+            (
+                file,
+                get_thread_pool_executor().submit(
+                    self._do_download_file,
+                    file,
+                    self.download_dir,
+                    partial(report_progress, file)
+                )
+            )
+            for file in other_files
+        ]
+        try:
+            results = [
+                self._do_download_file(largest_file, self.download_dir, partial(report_progress, largest_file))
+            ]
+            for file, future in futures:
+                if future.cancel():
+                    results.append(
+                        self._do_download_file(file, self.download_dir, partial(report_progress, file))
+                    )
+                else:
+                    results.append(future.result())
+        except BaseException:
+            # Don't let the partial files be discarded while other workers are still writing them
+            from concurrent.futures import wait
+
+            for __, future in futures:
+                future.cancel()
+            wait([future for __, future in futures])
+            raise
+        return results
 
     @classmethod
     def _do_download_file(cls, file, download_dir, progress_callback):
-        target_file = os.path.join(download_dir, file.name)
-        hasher = md5()
+        from hashlib import md5
+
+        target_file = os.path.join(download_dir, file.name + ".part")
+        # Only used to verify the download, which also keeps it usable in FIPS mode
+        hasher = md5(usedforsecurity=False)
         total_size = file.size_in_bytes
         downloaded_til_now = 0
-        with request.yield_response('GET', file.download_url) as response:
-            if response.status == 302:
-                file.download_url = response.getheader("Location")
-                return cls._do_download_file(file, download_dir, progress_callback)
-            file_buffer = open(target_file, "wb")
-            while True:
-                chunk = response.read(4096)
-                if not chunk:
-                    break
-                file_buffer.write(chunk)
-                hasher.update(chunk)
-                downloaded_til_now += len(chunk)
-                progress = math.floor((downloaded_til_now / total_size) * 100)
-                progress_callback(progress)
-            file_buffer.close()
-
+        last_progress = 0
+        # Large files redirect to a signed CDN URL of their own, so redirects
+        # can't be resolved once and shared between the files of a voice
+        with request.yield_response('GET', file.download_url, max_redirects=MAX_REDIRECTS) as response:
+            if 400 <= response.status < 600:
+                raise request.HTTPErrorStatus(response.status)
+            # Read into one reusable buffer rather than allocating a new chunk per read
+            buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+            with open(target_file, "wb") as file_buffer:
+                while True:
+                    read_size = response.readinto(buffer)
+                    if not read_size:
+                        break
+                    chunk = buffer[:read_size]
+                    file_buffer.write(chunk)
+                    hasher.update(chunk)
+                    downloaded_til_now += read_size
+                    progress = downloaded_til_now * 100 // total_size
+                    if progress != last_progress:
+                        progress_callback(progress)
+                        last_progress = progress
         return (file, target_file, hasher.hexdigest())
 
-    @staticmethod
-    def _done_callback_wrapper(done_callback, future):
-        if done_callback is None:
-            return
-        try:
-            result = future.result()
-        except Exception as e:
-            done_callback(e)
-        else:
-            done_callback(result)
 
-
-class PiperRTVoiceDownloader:
+class PiperRTVoiceDownloader(_DownloadProgressMixin):
     def __init__(self, voice: PiperVoice, success_callback):
+        import tempfile
+
         self.voice = voice
         self.success_callback = success_callback
         self.rt_download_url = self.voice.get_rt_variant_download_url()
-        self.temp_download_dir = tempfile.TemporaryDirectory()
-        self.progress_dialog = None
-
-    def update_progress(self, progress):
-        self.progress_dialog.Update(
-            progress,
-            # Translators: message of a progress dialog
-            _("Downloaded: {progress}%").format(progress=progress),
+        # Keep the archive on the same volume as the voices it is extracted to.
+        # Hidden directories are skipped when enumerating installed voices
+        os.makedirs(SONATA_VOICES_DIR, exist_ok=True)
+        self.temp_download_dir = tempfile.TemporaryDirectory(
+            prefix=".downloading_", dir=SONATA_VOICES_DIR
         )
 
     def done_callback(self, result):
         has_error = isinstance(result, Exception)
-        if not has_error:
-            self.progress_dialog.Update(
-                0,
-                # Translators: message shown in the voice download progress dialog
-                _("Installing voice")
-            )
-            try:
+        self._end_progress(installing=not has_error)
+        try:
+            if not has_error:
                 install_voice_from_tar_archive(result, SONATA_VOICES_DIR)
-            except:
-                log.exception("Failed to extract voice archive", exc_info=True)
-                has_error = True
-        self.progress_dialog.Hide()
-        self.progress_dialog.Destroy()
-        del self.progress_dialog
+        except:
+            log.exception("Failed to extract voice archive", exc_info=True)
+            has_error = True
+        finally:
+            # The archive sits in the voices folder, so don't leave it to the garbage collector
+            self.temp_download_dir.cleanup()
+        self._close_progress_dialog()
 
         if not has_error:
-            self.success_callback()
-            retval = gui.messageBox(
-            # Translators: content of a message box
-            _(
-                "Successfully downloaded fast variant of the voice  {voice}.\n"
-                "To use this voice, you need to restart NVDA.\n"
-                "Do you want to restart NVDA now?"
-            ).format(
-                voice=self.voice.key
-            ),
-            # Translators: title of a message box
-            _("Voice downloaded"),
-                wx.YES_NO | wx.ICON_WARNING,
-            )
-            if retval == wx.YES:
-                core.restart()
+            wx.CallAfter(self._on_voice_installed)
         else:
             wx.CallAfter(
                 gui.messageBox,
@@ -376,22 +537,37 @@ class PiperRTVoiceDownloader:
                 f"Failed to download voice.\nException: {result}"
             )
 
+    def _on_voice_installed(self):
+        self.success_callback()
+        retval = gui.messageBox(
+            # Translators: content of a message box
+            _(
+                "Successfully downloaded fast variant of the voice  {voice}.\n"
+                "To use this voice, you need to restart NVDA.\n"
+                "Do you want to restart NVDA now?"
+            ).format(
+                voice=self.voice.key
+            ),
+            # Translators: title of a message box
+            _("Voice downloaded"),
+            wx.YES_NO | wx.ICON_WARNING,
+        )
+        if retval == wx.YES:
+            core.restart()
+
     def download(self):
-        self.progress_dialog = wx.ProgressDialog(
+        self._show_progress_dialog(
             # Translators: title of a progress dialog
-            title=_("Downloading fast variant of the voice {voice}").format(
+            _("Downloading fast variant of the voice {voice}").format(
                 voice=self.voice.key
-            ),
-            # Translators: message of a progress dialog
-            message=_("Retrieving download information..."),
-            parent=gui.mainFrame,
+            )
         )
-        self.progress_dialog.CenterOnScreen()
-        THREAD_POOL_EXECUTOR.submit(self.download_voice_archive).add_done_callback(partial(self._done_callback_wrapper, self.done_callback))
+        get_thread_pool_executor().submit(self.download_voice_archive).add_done_callback(partial(_done_callback_wrapper, self.done_callback))
 
     def download_voice_archive(self):
         voice_name = self.rt_download_url.split("/")[-1].strip()
-        self.progress_dialog.Update(
+        wx.CallAfter(
+            self.progress_dialog.Update,
             0,
             # Translators: message shown in progress dialog
             _("Downloading file: {file}").format(file=voice_name)
@@ -402,116 +578,226 @@ class PiperRTVoiceDownloader:
     @classmethod
     def _do_download_archive(cls, download_url, voice_name, download_dir, progress_callback):
         target_file = os.path.join(download_dir, voice_name)
-        with request.yield_response('GET', download_url) as response:
-            if response.status == 302:
-                download_url = response.getheader("Location")
-                return cls._do_download_archive(download_url, voice_name, download_dir, progress_callback)
+        with request.yield_response('GET', download_url, max_redirects=MAX_REDIRECTS) as response:
+            if 400 <= response.status < 600:
+                raise request.HTTPErrorStatus(response.status)
             total_size = int(response.getheader("Content-Length"))
             downloaded_til_now = 0
-            file_buffer = open(target_file, "wb")
-            while True:
-                chunk = response.read(4096)
-                if not chunk:
-                    break
-                file_buffer.write(chunk)
-                downloaded_til_now += len(chunk)
-                progress = math.floor((downloaded_til_now / total_size) * 100)
-                progress_callback(progress)
-            file_buffer.close()
+            last_progress = 0
+            buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+            with open(target_file, "wb") as file_buffer:
+                while True:
+                    read_size = response.readinto(buffer)
+                    if not read_size:
+                        break
+                    file_buffer.write(buffer[:read_size])
+                    downloaded_til_now += read_size
+                    progress = downloaded_til_now * 100 // total_size
+                    if progress != last_progress:
+                        progress_callback(progress)
+                        last_progress = progress
         return target_file
 
-    @staticmethod
-    def _done_callback_wrapper(done_callback, future):
-        if done_callback is None:
-            return
-        try:
-            result = future.result()
-        except Exception as e:
-            done_callback(e)
-        else:
-            done_callback(result)
+
+def parse_voice_info(name):
+    """Split a voice name such as `en_US-amy-medium` into its language, name and quality.
+    Returns `None` if the name is not a valid voice name.
+    """
+    parts = _split_voice_name(name)
+    if parts is not None:
+        return dict(zip(("language", "name", "quality"), parts))
+
+
+@functools.lru_cache(maxsize=64)
+def _split_voice_name(name):
+    # Most names use `-` as the only separator, which doesn't need the regex
+    parts = name.split("-")
+    if (len(parts) == 3) and all(parts) and (parts[2].lower() in VOICE_QUALITIES):
+        return tuple(parts)
+    voice_info = VOICE_INFO_REGEX.match(name)
+    if voice_info is not None:
+        return voice_info.group("language", "name", "quality")
 
 
 def install_voice_from_tar_archive(tar_path, voices_dir):
-    tar = tarfile.open(tar_path)
-    filenames = {f.name: f for f in tar.getmembers()}
-    onnx_files = list(filter(
-        lambda pth: fnmatch(pth, "*.onnx"),
-        filenames
-    ))
-    config_files = list(filter(
-        lambda pth: fnmatch(pth, "*.json"),
-        filenames
-    ))
-    if not (onnx_files and config_files):
-        raise FileNotFoundError("Required files not found in archive")
-    if len(onnx_files) == 1:
-        voice_info = VOICE_INFO_REGEX.match(Path(onnx_files[0]).stem)
-    else:
-        voice_info = VOICE_INFO_REGEX.match(Path(tar_path).stem[:-4])
-    if voice_info is None:
-        raise FileNotFoundError("Required files not found in archive")
-    info = voice_info.groupdict()
-    voice_key = "-".join([
-        normalizeLanguage(info["language"]),
-        info["name"].replace("-", "_"),
-        info["quality"].replace("-", "_"),
-    ])
-    voice_folder_name = Path(voices_dir).joinpath(voice_key)
-    voice_folder_name.mkdir(parents=True, exist_ok=True)
-    voice_folder_name = os.fspath(voice_folder_name)
-    files_to_extract = [*onnx_files, *config_files]
-    if "MODEL_CARD" in filenames:
-        files_to_extract.append("MODEL_CARD")
-    for file in files_to_extract:
-        tar.extract(
-            filenames[file],
-            path=voice_folder_name,
-            set_attrs=False,
-        )
+    """Install the voice in the .tar.gz archive at `tar_path` into `voices_dir`, returning its key.
+    The archive is read sequentially in a single pass, so it is never re-read or memory mapped.
+    """
+    import shutil
+    import tarfile
+    import tempfile
+
+    if os.stat(tar_path).st_size < MIN_VOICE_ARCHIVE_SIZE:
+        raise ValueError(f"Voice archive is too small: {tar_path}")
+    # Read the archive as a stream, so that we decompress it only once
+    # and never hold more than one copy buffer of a member in memory.
+    # Members are copied by hand rather than with extract/extractall: this
+    # flattens their paths and skips restoring modes and owners.
+    # The whole archive is read, since a voice may ship more than one model.
+    # A gzip stream can only be decompressed in order, so members are
+    # copied one after another; extracting them from several threads
+    # would only make them wait on each other
+    staging_dir = tempfile.mkdtemp(prefix=".installing_", dir=voices_dir)
+    try:
+        onnx_files = []
+        config_files = []
+        has_model_card = False
+        with tarfile.open(tar_path, "r|gz", bufsize=TAR_READ_BUFFER_SIZE) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                filename = os.path.basename(member.name)
+                lower_filename = filename.lower()
+                if lower_filename.endswith(".onnx"):
+                    if not onnx_files and not (
+                        parse_voice_info(os.path.splitext(filename)[0])
+                        or parse_voice_info(Path(tar_path).stem[:-4])
+                    ):
+                        # Fail before extracting a model we cannot name
+                        raise FileNotFoundError("Required files not found in archive")
+                    onnx_files.append(filename)
+                elif lower_filename.endswith(".json"):
+                    config_files.append(filename)
+                elif filename == "MODEL_CARD":
+                    has_model_card = True
+                else:
+                    continue
+                target_file = os.path.join(staging_dir, filename)
+                with tar.extractfile(member) as src, open(target_file, "wb", buffering=0) as dst:
+                    # Small members such as the config are copied in a single read of their own size
+                    shutil.copyfileobj(src, dst, length=min(member.size, TAR_COPY_BUFFER_SIZE))
+        extracted_files = [*onnx_files, *config_files]
+        if has_model_card:
+            extracted_files.append("MODEL_CARD")
+        if not (onnx_files and config_files):
+            raise FileNotFoundError("Required files not found in archive")
+        if len(onnx_files) == 1:
+            info = parse_voice_info(os.path.splitext(onnx_files[0])[0])
+        else:
+            info = parse_voice_info(Path(tar_path).stem[:-4])
+        if info is None:
+            raise FileNotFoundError("Required files not found in archive")
+        voice_key = "-".join([
+            normalizeLanguage(info["language"]),
+            info["name"].replace("-", "_"),
+            info["quality"].replace("-", "_"),
+        ])
+        voice_folder_name = Path(voices_dir).joinpath(voice_key)
+        voice_folder_name.mkdir(parents=True, exist_ok=True)
+        for filename in extracted_files:
+            os.replace(
+                os.path.join(staging_dir, filename),
+                os.path.join(voice_folder_name, filename)
+            )
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        SonataTextToSpeechSystem.invalidate_voices_cache()
     return voice_key
 
 
+def _load_voice_list_etag(voice_list_file):
+    try:
+        with open(voice_list_file + ".etag", "r", encoding="utf-8") as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+
+def _save_voice_list_etag(voice_list_file, etag):
+    etag_file = voice_list_file + ".etag"
+    if not etag:
+        with contextlib.suppress(OSError):
+            os.remove(etag_file)
+        return
+    with open(etag_file, "w", encoding="utf-8") as file:
+        file.write(etag)
+
+
+def _get_not_installed_voices(voices):
+    installed_voices = SonataTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()
+    installed_voice_keys = {voice.key for voice in installed_voices}
+    fully_installed = set()
+    for (key, value) in voices.items():
+        std_key, rt_key = SonataTextToSpeechSystem.get_voice_variants(key)
+        value["standard_variant_installed"] = std_key in installed_voice_keys
+        value["fast_variant_installed"] = rt_key in installed_voice_keys
+        if value["standard_variant_installed"] and (
+            value["fast_variant_installed"] or not value["has_rt_variant"]
+        ):
+            fully_installed.add(value["key"])
+    return PiperVoice.from_list_of_dicts(voices.values(), skip_keys=fully_installed)
+
+
+def _download_voice_list(url, target_file):
+    """Stream the voice list at `url` into `target_file`, returning whether it changed.
+    If the list did not change since the last download, the local file is kept as is.
+    """
+    headers = {}
+    etag = _load_voice_list_etag(target_file)
+    if etag and os.path.exists(target_file):
+        headers["If-None-Match"] = etag
+    part_file = target_file + ".part"
+    with request.yield_response("GET", url, headers=headers, max_redirects=MAX_REDIRECTS) as response:
+        if response.status == 304:
+            return False
+        if 400 <= response.status < 600:
+            raise request.HTTPErrorStatus(response.status)
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        buffer = memoryview(bytearray(VOICE_LIST_CHUNK_SIZE))
+        with open(part_file, "wb") as file:
+            while True:
+                read_size = response.readinto(buffer)
+                if not read_size:
+                    break
+                file.write(buffer[:read_size])
+        etag = response.getheader("ETag")
+    os.replace(part_file, target_file)
+    _save_voice_list_etag(target_file, etag)
+    return True
+
+
+def _load_voice_list_from_local_cache():
+    # The lists are parsed in full, but the result is reused for `VOICE_LIST_CACHE_TTL`
+    # seconds (see `_voice_list_cache`), and only the voices that are not fully installed
+    # become `PiperVoice` objects
+    voices = json.loads(Path(PIPER_VOICES_JSON_LOCAL_CACHE).read_bytes())
+    rt_voices = json.loads(Path(RT_VOICES_JSON_LOCAL_CACHE).read_bytes())
+    rt_voice_names = {
+        vdata["base"]
+        for vdata in rt_voices.values()
+    }
+    for vname, vdata in voices.items():
+        vdata["has_rt_variant"] = vname in rt_voice_names
+    return voices
+
+
+def _cache_voice_list(voices):
+    _voice_list_cache["val"] = voices
+    _voice_list_cache["time"] = time.monotonic()
+
+
 def get_available_voices(force_online=False):
+    # Reuse the list parsed by a previous call in this session
+    if not force_online and (_voice_list_cache["time"] is not None):
+        if (time.monotonic() - _voice_list_cache["time"]) < VOICE_LIST_CACHE_TTL:
+            return _get_not_installed_voices(_voice_list_cache["val"])
     # Trry an offline cache first
-    if not force_online and os.path.exists(PIPER_VOICES_JSON_LOCAL_CACHE):
+    if not force_online:
         try:
-            with open(PIPER_VOICES_JSON_LOCAL_CACHE, "rb") as file:
-                voices = json.load(file)
+            voices = _load_voice_list_from_local_cache()
+        except FileNotFoundError:
+            pass
         except:
             log.exception("Failed to get voices from local file", exc_info=True)
         else:
-            installed_voices = SonataTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()
-            installed_voice_keys = {voice.key for voice in installed_voices}
-            not_installed = []
-            for (key, value) in voices.items():
-                std_key, rt_key = SonataTextToSpeechSystem.get_voice_variants(key)
-                value["standard_variant_installed"] = std_key in installed_voice_keys
-                value["fast_variant_installed"] = rt_key in installed_voice_keys
-                if value["standard_variant_installed"] and value["fast_variant_installed"]:
-                    continue
-                if value["standard_variant_installed"] and not value["has_rt_variant"]:
-                    continue
-                not_installed.append(value)
-            voice_objs = PiperVoice.from_list_of_dicts(not_installed)
-            return voice_objs
-    std_resp = request.get(PIPER_VOICE_LIST_URL)
-    std_resp.raise_for_status()
-    std_voices = std_resp.json()
-    rt_resp = request.get(RT_VOICE_LIST_URL)
-    rt_resp.raise_for_status()
-    rt_voice_names = {
-        vdata["base"]
-        for vdata in rt_resp.json().values()
-    }
-    voice_list = {}
-    for vname, vdata in std_voices.items():
-        if vname in rt_voice_names:
-            vdata["has_rt_variant"] = True
-        else:
-            vdata["has_rt_variant"] = False
-        voice_list[vname] = vdata
-    with open(PIPER_VOICES_JSON_LOCAL_CACHE, "w", encoding="utf-8") as file:
-        json.dump(voice_list, file, ensure_ascii=False, indent=2)
-    return get_available_voices()
-
+            _cache_voice_list(voices)
+            return _get_not_installed_voices(voices)
+    voices_changed = _download_voice_list(PIPER_VOICE_LIST_URL, PIPER_VOICES_JSON_LOCAL_CACHE)
+    rt_voices_changed = _download_voice_list(RT_VOICE_LIST_URL, RT_VOICES_JSON_LOCAL_CACHE)
+    if not (voices_changed or rt_voices_changed) and (_voice_list_cache["val"] is not None):
+        # Neither list changed, so the one parsed earlier is still current
+        voices = _voice_list_cache["val"]
+    else:
+        voices = _load_voice_list_from_local_cache()
+    _cache_voice_list(voices)
+    return _get_not_installed_voices(voices)
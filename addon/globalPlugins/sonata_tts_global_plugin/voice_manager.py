@@ -10,12 +10,11 @@ import functools
 import operator
 import os
 import shutil
-import tempfile
+import stat
 import threading
-import winsound
+from collections import OrderedDict, defaultdict
 
 import wx
-from wx.adv import CommandLinkButton
 import gui
 import synthDriverHandler
 from logHandler import log
@@ -28,15 +27,23 @@ from .components import AsyncSnakDialog, ColumnDefn, ImmutableObjectListView, Si
 from .sized_controls import SizedPanel
 
 
-with helpers.import_bundled_library():
-    import miniaudio
-    from pathlib import Path
+SONATA_SYNTH_NAME = "sonata_neural_voices"
+# Strips markdown heading and emphasis markers from model cards
+_MODEL_CARD_STRIP_TABLE = str.maketrans("", "", "#*")
+# A decoded preview takes a few hundred kilobytes
+PREVIEW_CACHE_SIZE = 16
 
 
 class InstalledSonataVoicesPanel(SizedPanel):
     def __init__(self, parent):
+        from wx.adv import CommandLinkButton
+
         super().__init__(parent, -1)
         self.__already_populated = threading.Event()
+        # Whether the synth should pick up the voices changed since the last refresh
+        self.__synth_voices_changed = False
+        # The voices tuple currently shown in the list
+        self._displayed_voices = None
         # Add controls
         # Translators: label for a list of installed voices
         voices_label = wx.StaticText(self, -1, _("Installed voices"))
@@ -45,13 +52,13 @@ class InstalledSonataVoicesPanel(SizedPanel):
             -1,
             columns=[
                 # Translators: list view column title
-                ColumnDefn(_("Name"), "left", 30, self._get_installed_voice_name),
+                ColumnDefn(_("Name"), "left", 100, operator.attrgetter("display_name")),
                 ColumnDefn(
                     # Translators: list view column title
-                    _("Quality"), "center", 30, lambda v: v.properties["quality"].title()
+                    _("Quality"), "center", 100, operator.attrgetter("display_quality")
                 ),
                 # Translators: list view column title
-                ColumnDefn(_("Language"), "right", 20, operator.attrgetter("language")),
+                ColumnDefn(_("Language"), "right", 100, operator.attrgetter("language")),
             ],
         )
         self.buttons_panel = SizedPanel(self, -1)
@@ -75,18 +82,53 @@ class InstalledSonataVoicesPanel(SizedPanel):
         self.Bind(wx.EVT_BUTTON, self.on_model_card, self.model_card_button)
         self.Bind(wx.EVT_BUTTON, self.on_remove_voice, self.remove_voice_button)
         self.Bind(wx.EVT_BUTTON, self._on_install_voice_from_tar, add_voice_button)
+        self._is_sonata = synthDriverHandler.getSynth().name == SONATA_SYNTH_NAME
+        synthDriverHandler.synthChanged.register(self._on_synth_changed)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self._on_destroy, self)
+
+    def _on_synth_changed(self, synth, **kwargs):
+        self._is_sonata = synth.name == SONATA_SYNTH_NAME
+
+    def _on_destroy(self, event):
+        synthDriverHandler.synthChanged.unregister(self._on_synth_changed)
+        event.Skip()
 
     def update_voices_list(self, set_focus=False, invalidate_synth_voices_cache=False):
-        voices = list(SonataTextToSpeechSystem.load_piper_voices_from_nvda_config_dir())
+        voices = SonataTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()
+        invalidate_synth_voices_cache = invalidate_synth_voices_cache or self.__synth_voices_changed
+        self.__synth_voices_changed = False
         enable = bool(voices)
         self.buttons_panel.Enable(enable)
-        self.voices_list.set_objects(voices, set_focus=set_focus)
-        if "sonata" in synthDriverHandler.getSynth().name.lower():
+        # The loader returns the same cached tuple as long as the voices directory
+        # did not change, so there is nothing to redraw in that case
+        if set_focus or (voices is not self._displayed_voices):
+            if voices is not self._displayed_voices:
+                # Voices may have been replaced on disk
+                _load_model_card.cache_clear()
+            self.voices_list.set_objects(voices, set_focus=set_focus)
+            self._displayed_voices = voices
+        if self._is_sonata:
             self.remove_voice_button.Enable(len(voices) >= 2)
             if invalidate_synth_voices_cache:
                 synth = synthDriverHandler.getSynth()
-                synth.terminate()
-                synth.__init__()
+                if hasattr(synth, "tts"):
+                    synth.refresh_voices()
+                else:
+                    # The synth was started without any installed voice.
+                    # Initializing it waits on the Sonata server, so keep that off the UI thread
+                    AsyncSnakDialog(
+                        executor=voice_download.get_thread_pool_executor(),
+                        func=synth.__init__,
+                        done_callback=self._after_synth_reinit,
+                        parent=self.GetTopLevelParent(),
+                        # Translators: message in a dialog
+                        message=_("Loading voices. Please wait..."),
+                    )
+        self.__already_populated.set()
+
+    def _after_synth_reinit(self, future):
+        if future.exception() is not None:
+            log.error("Failed to reinitialize Sonata synthesizer", exc_info=future.exception())
 
     def populate_list(self):
         if self.__already_populated.is_set():
@@ -95,25 +137,18 @@ class InstalledSonataVoicesPanel(SizedPanel):
 
     def invalidate_cache(self):
         self.__already_populated.clear()
-        if "sonata" in synthDriverHandler.getSynth().name.lower():
-            if invalidate_synth_voices_cache:
-                synth = synthDriverHandler.getSynth()
-                synth.terminate()
-                synth.__init__()
-
-    def _get_installed_voice_name(self, voice):
-        return f"{voice.name} ({voice.variant})"
+        self._displayed_voices = None
+        # Let the synth refresh its voices the next time this page is shown,
+        # rather than doing it here in the middle of a download
+        self.__synth_voices_changed = True
 
     def on_model_card(self, event):
         selected = self.voices_list.get_selected()
         if selected is None:
             self.voices_list.set_focused_item(0)
             return
-        model_card_file = os.path.join(selected.location, "MODEL_CARD")
-        if os.path.exists(model_card_file):
-            with open(model_card_file, "r", encoding="utf-8") as file:
-                content = file.read()
-            content = content.replace("#", "").replace("*", "")
+        content = _load_model_card(os.path.join(selected.location, "MODEL_CARD"))
+        if content is not None:
             gui.messageBox(
                 content,
                 #! Intentionally untranslatable 
@@ -135,11 +170,10 @@ class InstalledSonataVoicesPanel(SizedPanel):
         if selected is None:
             self.voices_list.set_focused_item(0)
             return
-        voice_id = "-".join(selected.key.split("-")[:-1])
-        synth = synthDriverHandler.getSynth()
+        # The synth voice id is the key of the voice's standard variant
         if (
-            (synth.name == "sonata_neural_voices")
-            and (synth.voice == voice_id)
+            self._is_sonata
+            and (synthDriverHandler.getSynth().voice == selected.standard_variant_key)
         ):
             gui.messageBox(
                 # Translators: message in a message box
@@ -160,26 +194,36 @@ class InstalledSonataVoicesPanel(SizedPanel):
             style=wx.YES_NO|wx.ICON_WARNING
         )
         if retval == wx.YES:
-            try:
-                shutil.rmtree(selected.location)
-            except:
-                log.exception("Failed to remove voice directory", exc_info=True)
-                gui.messageBox(
-                    # Translators: message in a message box
-                    _("Failed to remove voice.\nSee NVDA's log for more details."),
-                    # Translators: title of a message box
-                    _("Failed"),
-                    style=wx.ICON_WARNING
-                )
-            else:
-                gui.messageBox(
-                    # Translators: message in a message box
-                    _("Voice removed successfully."),
-                    # Translators: title of a message box
-                    _("Done"),
-                    style=wx.ICON_INFORMATION
-                )
-                self.update_voices_list(set_focus=True, invalidate_synth_voices_cache=True)
+            # The dialog is modal and can't be dismissed, so the voice can't be
+            # removed twice, nor the manager closed, until the removal is done
+            AsyncSnakDialog(
+                executor=voice_download.get_thread_pool_executor(),
+                func=lambda: remove_voice_directory(selected.location),
+                done_callback=self._after_remove,
+                parent=self.GetTopLevelParent(),
+                # Translators: message in a dialog
+                message=_("Removing voice. Please wait..."),
+            )
+
+    def _after_remove(self, future):
+        if future.exception() is not None:
+            log.error("Failed to remove voice directory", exc_info=future.exception())
+            gui.messageBox(
+                # Translators: message in a message box
+                _("Failed to remove voice.\nSee NVDA's log for more details."),
+                # Translators: title of a message box
+                _("Failed"),
+                style=wx.ICON_WARNING
+            )
+        else:
+            gui.messageBox(
+                # Translators: message in a message box
+                _("Voice removed successfully."),
+                # Translators: title of a message box
+                _("Done"),
+                style=wx.ICON_INFORMATION
+            )
+            self.update_voices_list(set_focus=True, invalidate_synth_voices_cache=True)
 
     def _on_install_voice_from_tar(self, event):
         openFileDialog = wx.FileDialog(
@@ -192,7 +236,7 @@ class InstalledSonataVoicesPanel(SizedPanel):
         )
         gui.runScriptModalDialog(
             openFileDialog,
-            functools.partial(self._get_process_tar_archive, openFileDialog),
+            lambda res: self._get_process_tar_archive(openFileDialog, res),
         )
 
     def _get_process_tar_archive(self, dialog, res):
@@ -201,10 +245,27 @@ class InstalledSonataVoicesPanel(SizedPanel):
         filepath = dialog.GetPath().strip()
         if not filepath:
             return
+        self.install_progress_dialog = wx.ProgressDialog(
+            # Translators: title of a progress dialog
+            title=_("Installing voice"),
+            # Translators: message of a progress dialog
+            message=_("Extracting voice archive. Please wait..."),
+            parent=gui.mainFrame,
+        )
+        self.install_progress_dialog.CenterOnScreen()
+        self.install_progress_dialog.Pulse()
+        voice_download.get_thread_pool_executor().submit(
+            voice_download.install_voice_from_tar_archive,
+            filepath,
+            SONATA_VOICES_DIR
+        ).add_done_callback(lambda future: wx.CallAfter(self._finish_install, future))
+
+    def _finish_install(self, future):
+        self.install_progress_dialog.Hide()
+        self.install_progress_dialog.Destroy()
+        del self.install_progress_dialog
         try:
-            voice_key = voice_download.install_voice_from_tar_archive(
-                filepath, SONATA_VOICES_DIR
-            )
+            voice_key = future.result()
         except:
             log.error("Failed to install voice from archive", exc_info=True)
             gui.messageBox(
@@ -233,6 +294,10 @@ class OnlineSonataVoicesPanel(SizedPanel):
         self.__already_populated = threading.Event()
         self.languages = []
         self.lang_to_voices = {}
+        # The voices list currently shown in the list view
+        self._displayed_voices = None
+        # Decoded previews, keyed by (voice key, speaker index)
+        self._preview_cache = OrderedDict()
         # Build controls
         # Translators: label of a choice
         wx.StaticText(self, -1, _("Language"))
@@ -240,9 +305,9 @@ class OnlineSonataVoicesPanel(SizedPanel):
         wx.StaticText(self, -1, _("Available voices"))
         voice_list_columns=[
             # Translators: list view column title
-            ColumnDefn(_("Name"), "left", 30, operator.attrgetter("name")),
+            ColumnDefn(_("Name"), "left", 100, operator.attrgetter("name")),
             # Translators: list view column title
-            ColumnDefn(_("Quality"), "center", 30, operator.attrgetter("quality")),
+            ColumnDefn(_("Quality"), "center", 100, operator.attrgetter("display_quality")),
         ]
         self.voices_list = ImmutableObjectListView(
             self,
@@ -281,8 +346,10 @@ class OnlineSonataVoicesPanel(SizedPanel):
         if not force_online and  self.__already_populated.is_set():
             return
         AsyncSnakDialog(
-            executor=voice_download.THREAD_POOL_EXECUTOR,
-            func=functools.partial(voice_download.get_available_voices, force_online=force_online),
+            executor=voice_download.get_thread_pool_executor(),
+            func=lambda: _group_voices_by_language(
+                voice_download.get_available_voices(force_online=force_online)
+            ),
             done_callback=self._voice_list_retrieved_callback,
             parent=self,
             # Translators: message in a dialog
@@ -291,6 +358,9 @@ class OnlineSonataVoicesPanel(SizedPanel):
         )
 
     def _voice_list_retrieved_callback(self, future):
+        if future.cancelled():
+            # The dialog was dismissed before the list was requested
+            return
         try:
             result = future.result()
         except:
@@ -302,7 +372,7 @@ class OnlineSonataVoicesPanel(SizedPanel):
                 style=wx.ICON_ERROR,
             )
             return
-        wx.CallAfter(self.set_voices, result)
+        wx.CallAfter(self.set_voices, *result)
 
     def invalidate_cache(self):
         self.__already_populated.clear()
@@ -311,18 +381,20 @@ class OnlineSonataVoicesPanel(SizedPanel):
         self.voices_list.Enable(True)
         selected_lang = self.languages[event.GetSelection()]
         voices = self.lang_to_voices[selected_lang]
-        self.voices_list.set_objects(voices, set_focus=False)
+        if voices is not self._displayed_voices:
+            self.voices_list.set_objects(voices, set_focus=False)
+            self._displayed_voices = voices
         self.voices_list.EnsureVisible(0)
         self.voices_list.Select(0)
         self.voices_list.SetItemState(0, wx.LIST_STATE_FOCUSED, wx.LIST_STATE_FOCUSED)
         self.buttons_panel.Enable(True)
-        self.speaker_choice.SetItems([])
+        _set_choice_items_if_changed(self.speaker_choice, [])
         self.speaker_choice.Enable(False)
 
     def on_voice_selected(self, event):
-        self.speaker_choice.SetItems([])
         selected_voice = self.voices_list.get_selected()
         if selected_voice is None:
+            _set_choice_items_if_changed(self.speaker_choice, [])
             return
         self.download_std_btn.Enable(not selected_voice.standard_variant_installed)
         self.download_rt_btn.Enable(
@@ -330,10 +402,10 @@ class OnlineSonataVoicesPanel(SizedPanel):
         )
         if selected_voice.num_speakers > 1:
             self.speaker_choice.Enable(True)
-            speakers = list(selected_voice.speaker_id_map.keys())
-            self.speaker_choice.SetItems(speakers)
+            _set_choice_items_if_changed(self.speaker_choice, selected_voice.speakers)
             self.speaker_choice.SetSelection(0)
         else:
+            _set_choice_items_if_changed(self.speaker_choice, [])
             self.speaker_choice.Enable(False)
 
     def on_speaker_selection_changed(self, event):
@@ -347,15 +419,27 @@ class OnlineSonataVoicesPanel(SizedPanel):
         if selected_voice.num_speakers > 1:
             speaker_idx = self.speaker_choice.GetSelection()
         mp3url = selected_voice.get_preview_url(speaker_idx=speaker_idx)
+        cache_key = (selected_voice.key, speaker_idx)
+        wav_data = self._preview_cache.get(cache_key)
+        if wav_data is not None:
+            self._preview_cache.move_to_end(cache_key)
         AsyncSnakDialog(
             # Translators: message in a dialog
             message=_("Playing preview..."),
             executor=aio.THREADED_EXECUTOR,
-            func=functools.partial(play_remote_mp3, mp3url),
-            done_callback=lambda future: True,
+            func=lambda: play_remote_mp3(mp3url, wav_data),
+            done_callback=lambda future: self._cache_preview(cache_key, future),
             parent=self.GetTopLevelParent()
         )
 
+    def _cache_preview(self, cache_key, future):
+        if future.exception() is not None:
+            return
+        self._preview_cache[cache_key] = future.result()
+        self._preview_cache.move_to_end(cache_key)
+        if len(self._preview_cache) > PREVIEW_CACHE_SIZE:
+            self._preview_cache.popitem(last=False)
+
     def on_download(self, event):
 
         def success_callback():
@@ -388,17 +472,11 @@ class OnlineSonataVoicesPanel(SizedPanel):
         downloader.download()
 
 
-    def set_voices(self, voices):
-        self.lang_to_voices = {}
-        for voice in voices:
-            self.lang_to_voices.setdefault(voice.language, []).append(voice)
-        for vlist in self.lang_to_voices.values():
-            vlist.sort(key=operator.attrgetter("key"))
-        self.languages = list(sorted(
-            self.lang_to_voices.keys(),
-            key=operator.attrgetter("name_english")
-        ))
-        self.language_choice.SetItems([lang.description for lang in self.languages])
+    def set_voices(self, languages, lang_to_voices, descriptions):
+        self.lang_to_voices = lang_to_voices
+        self._displayed_voices = None
+        self.languages = languages
+        self.language_choice.SetItems(descriptions)
         self.__already_populated.set()
 
 
@@ -455,15 +533,80 @@ class SonataVoiceManagerDialog(SimpleDialog):
             panel.invalidate_cache()
 
 
-def play_remote_mp3(mp3_url):
-    resp = voice_download.request.get(mp3_url)
-    resp.raise_for_status()
-    decoded_file = miniaudio.decode(resp.body, nchannels=1, sample_rate=22050)
-    with tempfile.TemporaryDirectory() as tempdir:
-        wav_file = os.path.join(tempdir, "speaker_0.wav")
-        miniaudio.wav_write_file(wav_file, decoded_file)
-        winsound.PlaySound(
-            wav_file,
-            winsound.SND_FILENAME | winsound.SND_PURGE
-        )
-
+@functools.lru_cache(maxsize=16)
+def _load_model_card(model_card_file):
+    """Return the model card stripped of markdown markers, or None if the voice has none."""
+    try:
+        with open(model_card_file, "r", encoding="utf-8") as file:
+            return file.read().translate(_MODEL_CARD_STRIP_TABLE)
+    except FileNotFoundError:
+        return None
+
+
+def _group_voices_by_language(voices):
+    """Group and sort the online voices, done in the worker thread to keep the UI responsive."""
+    lang_to_voices = defaultdict(list)
+    for voice in voices:
+        lang_to_voices[voice.language].append(voice)
+    voice_key = operator.attrgetter("key")
+    for vlist in lang_to_voices.values():
+        vlist.sort(key=voice_key)
+    languages = sorted(lang_to_voices, key=operator.attrgetter("name_english"))
+    # Hand out a plain dict, so that lookups never insert empty languages
+    return languages, dict(lang_to_voices), [lang.description for lang in languages]
+
+
+def _set_choice_items_if_changed(choice, items):
+    """Replace the items of a wx.Choice only when they differ, avoiding a redraw."""
+    if choice.GetItems() != items:
+        choice.SetItems(items)
+
+
+def _remove_readonly(func, path, exc_info):
+    """Clear the read-only flag of a file and retry removing it."""
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+def remove_voice_directory(voice_dir):
+    try:
+        shutil.rmtree(voice_dir, onerror=_remove_readonly)
+    finally:
+        SonataTextToSpeechSystem.invalidate_voices_cache()
+
+
+def play_remote_mp3(mp3_url, wav_data=None):
+    """Play a remote MP3 file, returning the wave data so that it can be replayed."""
+    import winsound
+
+    if wav_data is None:
+        wav_data = _fetch_mp3_as_wav(mp3_url)
+    winsound.PlaySound(wav_data, winsound.SND_MEMORY | winsound.SND_PURGE)
+    return wav_data
+
+
+def _fetch_mp3_as_wav(mp3_url):
+    import io
+    import wave
+
+    with helpers.import_bundled_library():
+        import miniaudio
+
+    # The MP3 bytes are only referenced during decoding, so they are freed
+    # before the wave buffer is built and while the preview plays
+    with voice_download.request.yield_response(
+        "GET", mp3_url, max_redirects=voice_download.MAX_REDIRECTS
+    ) as response:
+        if 400 <= response.status < 600:
+            raise voice_download.request.HTTPErrorStatus(response.status)
+        decoded_file = miniaudio.decode(response.read(), nchannels=1, sample_rate=22050)
+    # Build the wave file in memory
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, "wb") as wav_file:
+        wav_file.setnchannels(decoded_file.nchannels)
+        wav_file.setsampwidth(decoded_file.sample_width)
+        wav_file.setframerate(decoded_file.sample_rate)
+        # wave accepts any buffer, so the samples array is not copied to bytes
+        wav_file.writeframes(decoded_file.samples)
+    # A view keeps the buffer alive without copying it to bytes
+    return wav_buffer.getbuffer()
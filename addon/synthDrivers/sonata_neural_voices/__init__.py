@@ -231,11 +231,27 @@ class SynthDriver(synthDriverHandler.SynthDriver):
         self._player = self._get_or_create_player(
             self.tts.speech_options.voice.sample_rate
         )
+        self._update_voice_registry()
+        self.__voice = None
+
+    def _update_voice_registry(self):
         self.availableLanguages = {v.language for v in self.voices}
         self._voice_map = {v.key: v for v in self.voices}
         self._standard_voice_map = {v.standard_variant_key: v for v in self.voices}
         self.availableVoices = self._get_valid_voices()
-        self.__voice = None
+
+    def refresh_voices(self):
+        """Pick up installed or removed voices without restarting the synthesizer."""
+        # The voice manager can't invalidate this module's cache, and the directory
+        # modification time may not have changed on volumes with a coarse resolution
+        SonataTextToSpeechSystem.invalidate_voices_cache()
+        loaded_voices = {v.key: v for v in self.voices}
+        self.voices = [
+            loaded_voices.get(voice.key, voice)
+            for voice in SonataTextToSpeechSystem.load_piper_voices_from_nvda_config_dir()
+        ]
+        self.tts.voices = self.voices
+        self._update_voice_registry()
 
     def terminate(self):
         self.cancel()
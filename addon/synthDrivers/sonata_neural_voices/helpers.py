@@ -27,6 +27,14 @@ def import_bundled_library(lib_directory=LIB_DIRECTORY):
         sys.path.remove(lib_directory)
 
 
+def iter_voice_dirs(path):
+    """Yield (path, name) for each sub-directory of `path`, using the type info returned by `os.scandir`."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.path, entry.name
+
+
 def is_free_port(port):
     with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
         try:
@@ -4,6 +4,7 @@
 # This file is covered by the GNU General Public License.
 
 import copy
+import functools
 import operator
 import os
 from abc import ABC, abstractmethod
@@ -18,7 +19,13 @@ from languageHandler import normalizeLanguage
 from . import aio
 from . import grpc_client
 from .const import *
-from .helpers import import_bundled_library, LIB_DIRECTORY
+from .helpers import import_bundled_library, iter_voice_dirs, LIB_DIRECTORY
+
+
+# Installed voices keyed by the modification time of the voices directory, as a
+# `(signature, voices)` tuple: it is invalidated from worker threads, so it is
+# always read and replaced as a whole
+_voices_cache = (None, None)
 
 
 class VoiceNotFoundError(LookupError):
@@ -78,6 +85,12 @@ class SonataVoice:
     properties: Optional[Mapping[str, int]] = field(default_factory=dict)
     remote_id: str = None
     supports_streaming_output: bool = False
+    display_name: str = field(init=False, repr=False, compare=False)
+    display_quality: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.display_name = f"{self.name} ({self.variant})"
+        self.display_quality = self.properties.get("quality", "").title()
 
     @classmethod
     def from_path(cls, path):
@@ -359,6 +372,7 @@ class SonataTextToSpeechSystem:
             ]
 
     @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def get_voice_variants(voice_key):
         std_key = voice_key.replace("+RT", "")
         lang, name, quality = std_key.split("-")
@@ -372,18 +386,53 @@ class SonataTextToSpeechSystem:
 
     @classmethod
     def load_piper_voices_from_nvda_config_dir(cls):
-        Path(SONATA_VOICES_DIR).mkdir(parents=True, exist_ok=True)
-        return sorted(
-            cls.load_voices_from_directory(SONATA_VOICES_DIR),
-            key=operator.attrgetter("key"),
-        )
+        global _voices_cache
+        # A cache hit costs a single stat call
+        try:
+            signature = os.stat(SONATA_VOICES_DIR).st_mtime_ns
+        except FileNotFoundError:
+            Path(SONATA_VOICES_DIR).mkdir(parents=True, exist_ok=True)
+            signature = os.stat(SONATA_VOICES_DIR).st_mtime_ns
+        cached_signature, voices = _voices_cache
+        if cached_signature != signature:
+            voices = tuple(sorted(
+                cls.load_voices_from_directory(SONATA_VOICES_DIR),
+                key=operator.attrgetter("key"),
+            ))
+            _voices_cache = (signature, voices)
+        return voices
+
+    @staticmethod
+    def has_any_installed_voice():
+        """Cheaply check whether at least one voice model is installed."""
+        try:
+            for (directory, name) in iter_voice_dirs(SONATA_VOICES_DIR):
+                if name.startswith("."):
+                    # Staging directories are skipped, as in `load_voices_from_directory`
+                    continue
+                with os.scandir(directory) as voice_files:
+                    if any(f.name.endswith(".onnx") for f in voice_files):
+                        return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    @staticmethod
+    def invalidate_voices_cache():
+        global _voices_cache
+        _voices_cache = (None, None)
 
     @classmethod
     def load_voices_from_directory(
         cls, voices_directory, *, directory_name_prefix="voice-"
     ):
+        # Voices are built from their directory names alone, their config
+        # is only read by `SonataVoice.load` when a voice is first used
         rv = []
-        for directory in (d for d in Path(voices_directory).iterdir() if d.is_dir()):
+        for (directory, name) in iter_voice_dirs(voices_directory):
+            if name.startswith("."):
+                # Staging directories of voices being installed
+                continue
             try:
                 voice = SonataVoice.from_path(directory)
             except ValueError: